@@ -4,11 +4,16 @@ import logging
 import os
 import numpy
 import time
+import math
+import functools
+import queue
+import threading
 from typing import Tuple, List
 from enum import Enum, auto
 
 VGA_HORIZONTAL_SIZE: Tuple[int, int] = (640, 480)
 VGA_VERTICAL_SIZE: Tuple[int, int] = tuple(reversed(VGA_HORIZONTAL_SIZE))
+CPU_AVX2: int = 11  # cv::CPU_AVX2 from OpenCV's CpuFeatures enum, not exported by the Python bindings
 
 class Point:
     """
@@ -82,83 +87,212 @@ class Classifier:
     """
     Classifier tools and utilities
     """
-    def __init__(self, model_name: str, video_source: str = None, image = None) -> None:
+    def __init__(self, model_name: str, video_source: str = None, image = None, min_size: Tuple[int, int] = (0, 0), max_size: Tuple[int, int] = (0, 0), equalize: bool = False, opencl: bool = False) -> None:
         """
         Constructor of the class Classifier
         :param str model_name: relative path to the xml model
         :param str video_source: video source. If video_source is a string, it's supposed to be the relative path to a file, else video_source is converted to an integer and the video stream is treated like a cam
+        :param Tuple[int, int] min_size: minimum object size (width, height) in the processed frame. Smaller windows aren't scanned. (0, 0) means no bound
+        :param Tuple[int, int] max_size: maximum object size (width, height) in the processed frame. Bigger windows aren't scanned. (0, 0) means no bound
+        :param bool equalize: am I supposed to equalize the histogram of the processed frame?
+        :param bool opencl: am I supposed to run preprocessing and detection through OpenCL (Transparent API), if available?
         """
-        self.model_cascade: cv.CascadeClassifier = cv.CascadeClassifier()
-        self.model_cascade.load(cv.samples.findFile(model_name))
+        model_path: str = cv.samples.findFile(model_name)
+        self.model_cascade: cv.CascadeClassifier = load_cascade(model_path)
+        self.is_lbp: bool = is_lbp_cascade(model_path)
         self.video_source: str = video_source  # video_source == None if the classifier will be used on an image
         self.image: str = image  # image == None if the classifier will be used on the video source
-        self.start_time_int: int = None  # start_time will fill this attribute for the first time
-        self.times: numpy.array = None  # start will fill this attribute
-        self.times_index: int = 0  # Index to keep track of times array filling
+        self.is_cam: bool = video_source is not None and video_source.isnumeric()  # A numeric video source is a camera index
+        self.min_size: Tuple[int, int] = tuple(min_size)
+        self.max_size: Tuple[int, int] = tuple(max_size)
+        self.equalize: bool = equalize and not self.is_lbp  # LBP features compare pixels between them, so they're already invariant to contrast changes
+        if equalize and self.is_lbp:
+            logging.info("LBP cascade loaded, histogram equalization is skipped")
+        self.opencl: bool = opencl and cv.ocl.haveOpenCL()
+        if opencl and not self.opencl:
+            logging.warning("OpenCL isn't available, falling back to CPU")
+        if self.opencl:
+            cv.ocl.setUseOpenCL(True)
+        self.start_time_int: int = None  # start_time will fill this attribute for the first time (nanoseconds)
+        self.record_times: bool = False  # start will enable it for video files
+        self.times_count: int = 0  # Running stats of the time needed to classify one frame
+        self.times_sum: float = 0.0
+        self.times_min: float = math.inf
+        self.times_max: float = -math.inf
         self.main_window_created: bool = False
+        self.buffers_shape: Tuple[int, int] = None  # preprocess will allocate the buffers on the first frame
     
     def __start_time(self) -> None:
         """
         Get current time and save it into self.start_time. Used to compute the elapsed time afterwards
         """
-        self.start_time_int = time.time()
+        self.start_time_int = time.perf_counter_ns()
 
     def __end_time(self) -> None:
         """
-        Compute elapsed time (between start time and current time) and save it into self.times, in order to figure out what's the average time needed to classify one frame
+        Compute elapsed time (between start time and current time) and add it to the running stats, in order to figure out what's the average time needed to classify one frame
         """
-        logging.info(f"time for 1 frame classification {time.time() - self.start_time_int}")
-        if not str.isnumeric(self.video_source):  # If the video source is not a cam
-            self.times[self.times_index] = time.time() - self.start_time_int
-            self.times_index += 1
+        elapsed_time: float = (time.perf_counter_ns() - self.start_time_int) / 1e9
+        logging.info(f"time for 1 frame classification {elapsed_time}")
+        if self.record_times:  # If the video source is a video file
+            self.times_count += 1
+            self.times_sum += elapsed_time
+            self.times_min = min(self.times_min, elapsed_time)
+            self.times_max = max(self.times_max, elapsed_time)
     
-    def __draw_ellipse(self, frame: numpy.ndarray, region: Region) -> numpy.ndarray:
+    def __draw_ellipse(self, frame: numpy.ndarray, region: List[int]) -> numpy.ndarray:
         """
         Draw ellipse around a ROI
         :param numpy.ndarray frame: original frame
-        :pram Region region: ROI around which drawing the ellipse
+        :pram List[int] region: ROI (x, y, w, h) around which drawing the ellipse
         :return: new frame on with the ellipse
         """
-        return cv.ellipse(frame, region.get_center().to_tuple(), (region.w // 2, region.h // 2), 0, 0, 360, (0, 255, 0), 4)
+        x, y, w, h = region
+        return cv.ellipse(frame, (x + w // 2, y + h // 2), (w // 2, h // 2), 0, 0, 360, (0, 255, 0), 4)
     
-    def detect(self, frame: numpy.ndarray, processed_frame_preview: bool = False) -> List[Region]:
+    def __allocate_buffers(self, frame_shape: Tuple[int, int], size: Tuple[int, int]) -> None:
+        """
+        Allocate the buffers preprocess writes into, so that they're reused frame after frame instead of being allocated every time.
+        The processed frame size and the scale factors back to the original frame only depend on the frame shape too, so they're cached here
+        :param Tuple[int, int] frame_shape: shape (height, width) of the original frame
+        :param Tuple[int, int] size: size (width, height) of the processed frame
+        """
+        self.buffers_shape = frame_shape
+        self.processed_size: Tuple[int, int] = size
+        scale_factor_x: float = frame_shape[1] / size[0]  # both shape[1] and size[0] refer to the x (width)
+        scale_factor_y: float = frame_shape[0] / size[1]  # both shape[0] and size[1] refer to the y (height)
+        self.scale_factors: numpy.ndarray = numpy.array([scale_factor_x, scale_factor_y, scale_factor_x, scale_factor_y], dtype=numpy.float32)
+        self.resize_first: bool = False  # preprocess will measure which order is faster on the first color frame
+        if self.opencl:  # UMat results are allocated on the device by OpenCV itself
+            self.gray_buf = self.small_bgr_buf = self.small_buf = self.eq_buf = None
+            return
+        self.gray_buf: numpy.ndarray = numpy.empty(frame_shape, dtype=numpy.uint8)
+        self.small_bgr_buf: numpy.ndarray = numpy.empty((size[1], size[0], 3), dtype=numpy.uint8)
+        self.small_buf: numpy.ndarray = numpy.empty(size[::-1], dtype=numpy.uint8)
+        self.eq_buf: numpy.ndarray = numpy.empty(size[::-1], dtype=numpy.uint8)
+
+    def __downscale(self, img: numpy.ndarray, dst: numpy.ndarray = None) -> numpy.ndarray:
+        """
+        Downscale an image (grayscale or BGR) to the processed frame size
+        :param numpy.ndarray img: image with the same size of the original frame
+        :param numpy.ndarray dst: buffer to write the downscaled image into, None to allocate a new one
+        :return: the downscaled image
+        """
+        size: Tuple[int, int] = self.processed_size
+        height, width = self.buffers_shape
+        ratio: int = width // size[0]
+        if width == size[0] * ratio and height == size[1] * ratio and ratio & (ratio - 1) == 0:
+            # Integer power of two ratio (1, 2, 4...): pyrDown halves the frame with a fixed 5x5 kernel, much cheaper than area resampling
+            while ratio > 1:
+                ratio //= 2
+                img = cv.pyrDown(img, dst=dst if ratio == 1 else None)
+            return img
+        return cv.resize(img, dsize = size, dst=dst, interpolation = cv.INTER_AREA)
+
+    def __gray_then_downscale(self, frame: numpy.ndarray) -> numpy.ndarray:
+        """
+        Convert a BGR frame to grayscale at full resolution, then downscale it
+        :param numpy.ndarray frame: original BGR frame
+        :return: the downscaled grayscale frame
+        """
+        return self.__downscale(cv.cvtColor(frame, cv.COLOR_BGR2GRAY, dst=self.gray_buf), self.small_buf)
+
+    def __downscale_then_gray(self, frame: numpy.ndarray) -> numpy.ndarray:
+        """
+        Downscale a BGR frame, then convert it to grayscale: cvtColor only touches the processed frame pixels, but resize moves 3 channels
+        :param numpy.ndarray frame: original BGR frame
+        :return: the downscaled grayscale frame
+        """
+        return cv.cvtColor(self.__downscale(frame, self.small_bgr_buf), cv.COLOR_BGR2GRAY, dst=self.small_buf)
+
+    def __is_resize_first_faster(self, frame: numpy.ndarray, runs: int = 5) -> bool:
+        """
+        Measure whether downscaling before the grayscale conversion is faster than the other way round on this machine
+        :param numpy.ndarray frame: original BGR frame used as benchmark
+        :param int runs: runs per order, the best one is kept
+        :return: True if downscaling first is faster
+        """
+        timings: List[int] = list()
+        for step in (self.__gray_then_downscale, self.__downscale_then_gray):
+            best_time: int = None
+            for _ in range(runs):
+                start_time: int = time.perf_counter_ns()
+                step(frame)
+                elapsed_time: int = time.perf_counter_ns() - start_time
+                best_time = elapsed_time if best_time is None else min(best_time, elapsed_time)
+            timings.append(best_time)
+        logging.debug(f"grayscale then downscale {timings[0] / 1e9}, downscale then grayscale {timings[1] / 1e9}")
+        return timings[1] < timings[0]
+
+    def prepare(self, frame: numpy.ndarray) -> None:
+        """
+        Get ready to preprocess frames shaped like frame: allocate the buffers and, for color frames, measure the fastest grayscale/downscale order.
+        It does nothing if the frame shape didn't change. detect calls it before starting the timer, so that the one-time setup doesn't end up in the frame timing stats
+        :param numpy.ndarray frame: original BGR or grayscale frame
+        """
+        if self.buffers_shape == frame.shape[:2]:
+            return
+        orientation: Orientation = Orientation.get_orientation(frame)
+        if orientation is Orientation.VERTICAL:
+            self.__allocate_buffers(frame.shape[:2], VGA_VERTICAL_SIZE)
+        else:
+            self.__allocate_buffers(frame.shape[:2], VGA_HORIZONTAL_SIZE)
+        if frame.ndim == 3 and not self.opencl:
+            self.resize_first = self.__is_resize_first_faster(frame)
+
+    def preprocess(self, frame: numpy.ndarray) -> Tuple[numpy.ndarray, Tuple[int, int]]:
+        """
+        Turn a frame into the input expected by the cascade: grayscale, downscaled to VGA resolution and, if requested, equalized.
+        Be aware that the processed frame is a reused buffer: it's overwritten by the next call. With OpenCL it's a cv.UMat
+        :param numpy.ndarray frame: original BGR or grayscale frame
+        :return: the processed frame and its size (width, height)
+        """
+        self.prepare(frame)
+        frame_is_mono: bool = frame.ndim == 2
+        if self.opencl:  # Transparent API: the calls below dispatch to OpenCL kernels when they get a cv.UMat
+            frame = cv.UMat(frame)
+        if frame_is_mono:  # The source already delivers 8-bit mono frames
+            downscaled_frame_gray: numpy.ndarray = self.__downscale(frame, self.small_buf)
+        elif self.resize_first:
+            downscaled_frame_gray: numpy.ndarray = self.__downscale_then_gray(frame)
+        else:
+            downscaled_frame_gray: numpy.ndarray = self.__gray_then_downscale(frame)
+        if self.equalize:
+            downscaled_frame_gray = cv.equalizeHist(downscaled_frame_gray, dst=self.eq_buf)
+        return downscaled_frame_gray, self.processed_size
+
+    def detect(self, frame: numpy.ndarray, processed_frame_preview: bool = False) -> numpy.ndarray:
         """
         Detect objects according to the model
         :param numpy.ndarray frame: frame against which run the classifier
         :param bool processed_frame_preview: am I supposed to show the processed frame?
-        :return: a list of regions where the object has been found
+        :return: an int32 array of shape (N, 4) with the regions (x, y, w, h) where the object has been found
         """
+        self.prepare(frame)
         self.__start_time()
-        frame_gray: numpy.ndarray = cv.cvtColor(frame, cv.COLOR_BGR2GRAY)
-        orientation: Orientation = Orientation.get_orientation(frame)
-        if orientation is Orientation.VERTICAL:
-            size: Tuple[int, int] = VGA_VERTICAL_SIZE
-        elif orientation is Orientation.HORIZONTAL:
-            size: Tuple[int, int] = VGA_HORIZONTAL_SIZE
-        downscaled_frame_gray: numpy.ndarray = cv.resize(frame_gray, dsize = size, interpolation = cv.INTER_AREA)
-        downscaled_frame_gray: numpy.ndarray = cv.equalizeHist(downscaled_frame_gray)
-        obj_list = self.model_cascade.detectMultiScale(downscaled_frame_gray, scaleFactor = 1.2)
+        downscaled_frame_gray, _ = self.preprocess(frame)
+        obj_list = self.model_cascade.detectMultiScale(downscaled_frame_gray, scaleFactor = 1.2, minSize = self.min_size, maxSize = self.max_size)
         self.__end_time()
-        original_frame_regions_list: List[Region] = list()
-        processed_frame_regions_list: List[Region] = list()
-        scale_factor_x: float = frame.shape[1] / size[0]  # both shape[1] and size[0] refer to the x (width)
-        scale_factor_y: float = frame.shape[0] / size[1]  # both shape[0] and size[1] refer to the y (height)
-        for (x, y, w, h) in obj_list:
-            processed_frame_regions_list.append(Region(x, y, w, h))
-            original_frame_regions_list.append(Region(x*scale_factor_x, y*scale_factor_y, w*scale_factor_x, h*scale_factor_y))
+        # detectMultiScale returns an empty tuple when nothing is found, hence the reshape
+        processed_frame_regions: numpy.ndarray = numpy.asarray(obj_list, dtype=numpy.int32).reshape(-1, 4)
+        original_frame_regions: numpy.ndarray = (processed_frame_regions * self.scale_factors).astype(numpy.int32)
         if processed_frame_preview:
-            self.display(downscaled_frame_gray, processed_frame_regions_list, 'Processed frame preview')
-        return original_frame_regions_list
+            if self.opencl:
+                downscaled_frame_gray = downscaled_frame_gray.get()
+            elif downscaled_frame_gray is frame:  # Mono VGA source: don't draw the preview ellipses on the original frame
+                downscaled_frame_gray = downscaled_frame_gray.copy()
+            self.display(downscaled_frame_gray, processed_frame_regions, 'Processed frame preview')
+        return original_frame_regions
 
-    def display(self, frame: numpy.ndarray, regions: List[Region], window_title: str = 'OpenCV show image', scale_factor: float = 1.0) -> None:
+    def display(self, frame: numpy.ndarray, regions: numpy.ndarray, window_title: str = 'OpenCV show image', scale_factor: float = 1.0) -> None:
         """
         Display a frame drawing a series of ellipses around the regions of interest
         :param numpy.ndarray frame: original frame
-        :param List[Region] regions: regions of interest list
+        :param numpy.ndarray regions: regions of interest array of shape (N, 4), one (x, y, w, h) row per region
         :param str window_title: window's title
         :param float scale_factor: the frame will be scaled according to this value for better view
         """
-        for region in regions:
+        for region in regions.tolist():  # A single conversion to Python ints for all the regions
             frame: numpy.ndarray = self.__draw_ellipse(frame, region)
         cv.imshow(window_title, scale(frame, scale_factor))
         if not self.main_window_created:
@@ -171,9 +305,45 @@ class Classifier:
         :param numpy.ndarray frame: original frame
         :param bool processed_frame_preview: am I supposed to show the processed frame?
         """
-        regions: List[Region] = self.detect(frame, processed_frame_preview)
+        regions: numpy.ndarray = self.detect(frame, processed_frame_preview)
         self.display(frame, regions, 'Face detection with HCC', 0.5)  # HCC - Haar Cascade Classifier
 
+    def __put_frame(self, frames: queue.Queue, frame: numpy.ndarray, stop: threading.Event) -> None:
+        """
+        Push a frame into the queue, waiting for a free slot unless the consumer asked to stop
+        :param queue.Queue frames: queue shared with the consumer
+        :param numpy.ndarray frame: frame to push (None signals the end of the stream)
+        :param threading.Event stop: set by the consumer when it doesn't want frames anymore
+        """
+        while not stop.is_set():
+            try:
+                frames.put(frame, timeout=0.1)
+                return
+            except queue.Full:
+                continue
+
+    def __capture_loop(self, cap: cv.VideoCapture, frames: queue.Queue, wanted: threading.Event, stop: threading.Event) -> None:
+        """
+        Read frames from cap and push them into frames, so that capture overlaps with classification. Runs on the capture thread
+        :param cv.VideoCapture cap: opened video stream
+        :param queue.Queue frames: 1-slot queue shared with the consumer
+        :param threading.Event wanted: set by the consumer right before it waits for the next frame
+        :param threading.Event stop: set by the consumer when it doesn't want frames anymore
+        """
+        drop_frames: bool = self.is_cam  # A cam must stay real time, a video file must be fully classified
+        while not stop.is_set():
+            if not cap.grab():
+                break
+            if drop_frames:
+                if not wanted.is_set():
+                    continue  # The consumer is still busy: drop this frame without decoding it, a fresher one will be grabbed
+                wanted.clear()
+            ret, frame = cap.retrieve()
+            if frame is None:
+                break
+            self.__put_frame(frames, frame, stop)
+        self.__put_frame(frames, None, stop)
+
     def start(self, processed_frame_preview: bool) -> None:  # Blocking method
         """
         Start video capture and frames classification. Be aware that it's a blocking method (it enters a loop)
@@ -185,25 +355,59 @@ class Classifier:
             if cv.waitKey(0) == 27:  # Key ==> 'ESC'
                 return
 
-        cap = cv.VideoCapture(int(self.video_source) if str.isnumeric(self.video_source) else self.video_source)
+        cap = cv.VideoCapture(int(self.video_source) if self.is_cam else self.video_source)
         frames_number: int = int(cap.get(cv.CAP_PROP_FRAME_COUNT))
         if frames_number > 0:  # frames_num < 0 when the video source is a camera
-            self.times = numpy.empty(frames_number, dtype='f', order='C')
+            self.record_times = True
         if not cap.isOpened():
             logging.error("Camera video stream can't be opened")
             exit(1)
+        cv.setNumThreads(max(1, (os.cpu_count() or 1) - 1))  # Leave one core to the capture thread
+        frames: queue.Queue = queue.Queue(maxsize=1)
+        wanted: threading.Event = threading.Event()
+        stop: threading.Event = threading.Event()
+        capture_thread = threading.Thread(target=self.__capture_loop, args=(cap, frames, wanted, stop), daemon=True)
+        capture_thread.start()
         while True:
-            ret, frame = cap.read()
+            wanted.set()  # A cam decodes only the first frame grabbed from now on, so the classified frame is always the freshest one
+            frame = frames.get()
             if frame is None:
                 break
             self.detect_and_display(frame, processed_frame_preview)
             if cv.waitKey(1) == 27:  # Key ==> 'ESC'
                 break
+        stop.set()
+        capture_thread.join()
+        cap.release()
         # When classification is done, print the average time needed to classify each frame
-        if frames_number > 0:
-            logging.info(f"Average time needed to classify each frame {numpy.average(self.times[:self.times_index])}")
-            logging.info(f"Max time needed to classify each frame {numpy.amax(self.times[:self.times_index])}")
-            logging.info(f"Min time needed to classify each frame {numpy.amin(self.times[:self.times_index])}")
+        if self.times_count > 0:
+            logging.info(f"Average time needed to classify each frame {self.times_sum / self.times_count}")
+            logging.info(f"Max time needed to classify each frame {self.times_max}")
+            logging.info(f"Min time needed to classify each frame {self.times_min}")
+
+@functools.lru_cache(maxsize=None)
+def load_cascade(model_path: str) -> cv.CascadeClassifier:
+    """
+    Load a cascade model, parsing each xml only once: the same instance is returned for the same path.
+    Be aware that detectMultiScale changes the cascade internal state, so a shared instance must only be used from one thread at a time
+    :param str model_path: resolved path to the xml model (see cv.samples.findFile)
+    :return: the loaded cascade classifier
+    """
+    model_cascade: cv.CascadeClassifier = cv.CascadeClassifier()
+    model_cascade.load(model_path)
+    return model_cascade
+
+@functools.lru_cache(maxsize=None)
+def is_lbp_cascade(model_path: str) -> bool:
+    """
+    Tell whether a cascade model uses LBP features, reading its featureType
+    :param str model_path: path to the xml model
+    :return: True if it's an LBP cascade. Haar models, both in the old and in the new format, return False
+    """
+    fs = cv.FileStorage(model_path, cv.FILE_STORAGE_READ)
+    feature_type: str = fs.getFirstTopLevelNode().getNode('featureType').string()
+    fs.release()
+    return feature_type.upper() == 'LBP'
 
 def scale(img: numpy.ndarray, scale_factor: float) -> numpy.ndarray:  # scale_factor between 0 and 1 if you want to scale down the image
     """
@@ -215,8 +419,19 @@ def scale(img: numpy.ndarray, scale_factor: float) -> numpy.ndarray:  # scale_fa
     scaled_w: int = int(img.shape[1] * scale_factor)
     return cv.resize(img, (scaled_w, scaled_h))
 
-def main(video_source: str, image: str, model: str, processed_frame_preview: bool) -> None:
-    classifier = Classifier(model, video_source = video_source, image = image)
+def check_optimizations() -> None:
+    """
+    Enable OpenCV optimized code paths and warn if the loaded build can't use AVX2 kernels on this machine
+    """
+    cv.setUseOptimized(True)
+    if 'AVX2' not in cv.getBuildInformation():
+        logging.warning("OpenCV has been built without AVX2 support, preprocessing and detection will fall back to slower SIMD kernels")
+    elif not cv.checkHardwareSupport(CPU_AVX2):
+        logging.warning("This CPU doesn't support AVX2, preprocessing and detection will fall back to slower SIMD kernels")
+
+def main(video_source: str, image: str, model: str, processed_frame_preview: bool, min_size: Tuple[int, int], max_size: Tuple[int, int], equalize: bool, opencl: bool) -> None:
+    check_optimizations()
+    classifier = Classifier(model, video_source = video_source, image = image, min_size = min_size, max_size = max_size, equalize = equalize, opencl = opencl)
     classifier.start(processed_frame_preview)
 
 if __name__ == "__main__":
@@ -226,5 +441,9 @@ if __name__ == "__main__":
     parser.add_argument('--source', help='Camera number or video filename', type=str, default='0')
     parser.add_argument('--image', help='Image filename', type=str)
     parser.add_argument('--processed-frame-preview', help='Show the preview of processed frame', default=False, action='store_true')
+    parser.add_argument('--min-size', help='Minimum object size in the processed frame', type=int, nargs=2, metavar=('WIDTH', 'HEIGHT'), default=(0, 0))
+    parser.add_argument('--max-size', help='Maximum object size in the processed frame', type=int, nargs=2, metavar=('WIDTH', 'HEIGHT'), default=(0, 0))
+    parser.add_argument('--equalize', help='Equalize the histogram of the processed frame', default=False, action='store_true')
+    parser.add_argument('--opencl', help='Run preprocessing and detection through OpenCL, if available', default=False, action='store_true')
     args = parser.parse_args()
-    main(args.source, args.image, os.path.join(os.path.split(os.path.abspath(cv.__file__))[0], 'data', args.model), args.processed_frame_preview)
+    main(args.source, args.image, os.path.join(os.path.split(os.path.abspath(cv.__file__))[0], 'data', args.model), args.processed_frame_preview, args.min_size, args.max_size, args.equalize, args.opencl)